@@ -1,25 +1,61 @@
 """Submission for BGGP3 test script"""
+from json import dumps, loads
+from os import close, memfd_create, stat, write
 from pathlib import Path
 from re import search as rsearch
+from shutil import which
 from subprocess import run
-from tempfile import NamedTemporaryFile
 
-name = NamedTemporaryFile(suffix="bggp3.crash.c").name
-Path(name).write_text("int main(){}", "utf-8")
+# Keep the source in an anonymous in-memory file instead of a temp file on disk
+fd = memfd_create("bggp3.crash.c")
+write(fd, b"int main(){}")
+name = f"/proc/self/fd/{fd}"
 
-version = run(["clang", "--version"], check=True, capture_output=True).stdout
+# Cache `clang --version` keyed on the resolved clang binary so repeat runs skip
+# the extra fork/exec
+clang_path = which("clang")
+assert (
+    clang_path is not None
+), "clang was not found on PATH! Visit https://apt.llvm.org/ to get it."
+
+clang_stat = stat(clang_path)
+key = [clang_stat.st_ino, clang_stat.st_mtime_ns]
+cache_path = Path.home() / ".cache" / "bggp3" / "clang_version"
+
+# A missing, corrupt or stale cache is a miss
+try:
+    cached = loads(cache_path.read_text("utf-8"))
+    version = cached["version"] if cached["key"] == key else None
+except (OSError, ValueError, KeyError, TypeError):
+    version = None
+
+if version is None:
+    output = run(["clang", "--version"], check=True, capture_output=True).stdout
+    version = output.decode("utf-8", errors="ignore")
+    # The cache is best effort, an unwritable home must not stop the crash
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(dumps({"key": key, "version": version}), "utf-8")
+    except OSError:
+        pass
 
 assert (
-    rsearch(rb"15.0.0", version) is not None
+    rsearch(r"15.0.0", version) is not None
 ), "This crash only works on clang 15.0.0! Visit https://apt.llvm.org/ to get it."
 
 CMD = [
     "clang",
     "-target",
     "i386-apple-windows-eabi",
+    # The memfd path has no `.c` extension for clang to infer the language from
+    "-x",
+    "c",
     # Uncomment this flag to be able to remove `int ` from the source code
     # "-Wno-implicit-int",
     name,
 ]
 
-run(CMD, check=True, shell=False)
+try:
+    run(CMD, check=True, shell=False, pass_fds=(fd,))
+finally:
+    close(fd)
@@ -2,22 +2,47 @@
 Utilities to check for valid triples for clang
 """
 
-from asyncio import (
-    FIRST_COMPLETED,
-    StreamReader,
-    create_subprocess_exec,
-    create_task,
-    gather,
-    get_event_loop,
-    wait,
-)
-from asyncio.subprocess import PIPE
+from asyncio import Queue, Runner, Semaphore, TaskGroup, create_subprocess_exec
+from asyncio.subprocess import PIPE, STDOUT
+from contextvars import Context
 from enum import Enum
+from hashlib import blake2b
 from itertools import product
-from os import unlink
+from multiprocessing import Pool
+from multiprocessing import Queue as ProcessQueue
+from os import replace, sched_getaffinity, sched_setaffinity, stat
 from pathlib import Path
-from typing import AsyncGenerator, Tuple
-from uuid import uuid1
+from sys import stdout
+from typing import Any, Coroutine, Container, Dict, List, Optional, Tuple, TypeVar
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    from pybloom_live import BloomFilter
+except ImportError:
+    BloomFilter = None
+
+TASK_COUNT = 32
+SOURCE = b"int main(){return 1;}"
+CMD_PREFIX = ("/home/novafacing/hub/llvm-project/llvm/build/bin/clang", "-target")
+# -fno-crash-diagnostics skips writing out preprocessed reproducers on a crash,
+# the stack trace is all that is needed
+CMD_SUFFIX = ("-fno-crash-diagnostics", "-x", "c", "-o", "/dev/null", "-")
+CRASH_MARKER = b"PLEASE"
+BAD_TRIPLES_DIR = Path(".")
+CHECKPOINT_SIZE = 10_000
+# Nothing here uses contextvars, so every task can share one empty context
+# instead of copying the current one on creation
+EMPTY_CONTEXT = Context()
+
+
+T = TypeVar("T")
+
+# (shard id, concurrent clangs) for this pool process, set by `init_shard`
+SHARD = (0, TASK_COUNT)
 
 
 class ClangArch(str, Enum):
@@ -74,17 +99,17 @@ class ClangArch(str, Enum):
     mipsel = "mipsel"
     mipsallegrexel = "mipsallegrexel"
     mipsisa32r6el = "mipsisa32r6el"
-    mipsr6el = "mipsr6el,"
+    mipsr6el = "mipsr6el"
     mips64 = "mips64"
     mips64eb = "mips64eb"
     mipsn32 = "mipsn32"
-    mipsisa64r6 = "mipsisa64r6,"
+    mipsisa64r6 = "mipsisa64r6"
     mips64r6 = "mips64r6"
     mipsn32r6 = "mipsn32r6"
     mips64el = "mips64el"
     mipsn32el = "mipsn32el"
     mipsisa64r6el = "mipsisa64r6el"
-    mips64r6el = "mips64r6el,"
+    mips64r6el = "mips64r6el"
     mipsn32r6el = "mipsn32r6el"
     r600 = "r600"
     amdgcn = "amdgcn"
@@ -113,14 +138,14 @@ class ClangArch(str, Enum):
     spirv32 = "spirv32"
     spirv32v1_0 = "spirv32v1.0"
     spirv32v1_1 = "spirv32v1.1"
-    spirv32v1_2 = "spirv32v1.2,"
+    spirv32v1_2 = "spirv32v1.2"
     spirv32v1_3 = "spirv32v1.3"
     spirv32v1_4 = "spirv32v1.4"
     spirv32v1_5 = "spirv32v1.5"
     spirv64 = "spirv64"
     spirv64v1_0 = "spirv64v1.0"
     spirv64v1_1 = "spirv64v1.1"
-    spirv64v1_2 = "spirv64v1.2,"
+    spirv64v1_2 = "spirv64v1.2"
     spirv64v1_3 = "spirv64v1.3"
     spirv64v1_4 = "spirv64v1.4"
     spirv64v1_5 = "spirv64v1.5"
@@ -261,116 +286,323 @@ class ClangEnvironment(str, Enum):
     NONE = ""
 
 
-async def check_valid_triple(triple: str, input_file: str) -> Tuple[bool, str]:
+# The enums are only ever used for their values, so materialize them once
+ARCHS = tuple(arch.value for arch in ClangArch)
+VENDORS = tuple(vendor.value for vendor in ClangVendor)
+OSES = tuple(op_s.value for op_s in ClangOS)
+ENVIRONMENTS = tuple(environ.value for environ in ClangEnvironment)
+
+
+def run_loop(coro: Coroutine[Any, Any, T]) -> T:
     """
-    Check if a triple is valid
+    Run a coroutine to completion on a fresh event loop, using uvloop when it is
+    installed
     """
+    loop_factory = None if uvloop is None else uvloop.new_event_loop
 
-    cmd = [
-        "/home/novafacing/hub/llvm-project/llvm/build/bin/clang",
-        "-target",
-        triple,
-        "-x",
-        "c",
-        "-o",
-        "/dev/null",
-        input_file,
-    ]
+    with Runner(loop_factory=loop_factory) as runner:
+        return runner.run(coro)
+
+
+async def run_clang(triple: str) -> Tuple[int, bytes, bool]:
+    """
+    Compile `SOURCE` for a triple, returning clang's return code, its combined
+    stdout and stderr, and whether it crashed. The source is fed over stdin so
+    clang never opens an input file
+    """
 
+    # No fds need closing in the child. On the stock asyncio loop close_fds=False
+    # lets the subprocess module spawn with posix_spawn instead of fork + exec;
+    # uvloop spawns through libuv's uv_spawn and ignores it
     res = await create_subprocess_exec(
-        *cmd,
+        *CMD_PREFIX,
+        triple,
+        *CMD_SUFFIX,
+        stdin=PIPE,
         stdout=PIPE,
-        stderr=PIPE,
+        stderr=STDOUT,
+        close_fds=False,
     )
 
-    async def read_stream(stream: StreamReader) -> bytes:
-        out = b""
-        while True:
-            data = await stream.read(1024)
-            if not data:
-                break
-            out += data
-        return out
-
-    out, err = await gather(
-        read_stream(res.stdout),
-        read_stream(res.stderr),
+    try:
+        res.stdin.write(SOURCE)
+        await res.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # clang can reject the triple and exit before reading its input
+        pass
+    res.stdin.close()
+
+    # Scan each chunk for the crash marker as it arrives, with enough of the
+    # previous chunk to catch a marker split across reads. Reading carries on
+    # after a hit because the stack trace follows the marker
+    out = bytearray()
+    crashed = False
+    overlap = len(CRASH_MARKER) - 1
+    while chunk := await res.stdout.read(65536):
+        if not crashed:
+            crashed = (out[-overlap:] + chunk).find(CRASH_MARKER) >= 0
+        out.extend(chunk)
+
+    await res.wait()
+
+    return res.returncode, bytes(out), crashed
+
+
+async def check_valid_triple(triple: str) -> Tuple[bool, str]:
+    """
+    Check if a triple is valid
+    """
+
+    returncode, out, crashed = await run_clang(triple)
+
+    if crashed:
+        return False, out
+
+    return returncode == 0, ""
+
+
+async def classify_triple(triple: str) -> str:
+    """
+    Classify the result of compiling with a triple by its diagnostic signature,
+    one of "ok", "crash", "unknown_triple" or "error"
+    """
+
+    returncode, out, crashed = await run_clang(triple)
+
+    if crashed:
+        return "crash"
+
+    if returncode == 0:
+        return "ok"
+
+    if b"unknown target triple" in out:
+        return "unknown_triple"
+
+    return "error"
+
+
+async def probe_compatibility() -> Dict[Tuple[str, str], str]:
+    """
+    Probe each (arch, os) pair so that combinations clang rejects outright can be
+    skipped for every vendor and environment
+
+    The driver picks its toolchain partly by vendor and environment, so a pair is
+    only reported as "unknown_triple" if the bare `arch--os` triple and every
+    variant with a single non-empty vendor or environment are all rejected. This
+    assumes a vendor and an environment never make a rejected pair valid only in
+    combination
+    """
+    archs = [arch for arch in ARCHS if arch]
+    oses = [op_s for op_s in OSES if op_s]
+    vendors = [vendor for vendor in VENDORS if vendor]
+    envs = [environ for environ in ENVIRONMENTS if environ]
+    compat = {}
+    sem = Semaphore(TASK_COUNT)
+
+    async def probe(arch: str, op_s: str) -> None:
+        try:
+            result = await classify_triple(f"{arch}--{op_s}")
+
+            variants = [f"{arch}-{vendor}-{op_s}" for vendor in vendors] + [
+                f"{arch}--{op_s}-{environ}" for environ in envs
+            ]
+            for variant in variants:
+                if result != "unknown_triple":
+                    break
+                result = await classify_triple(variant)
+
+            compat[(arch, op_s)] = result
+        finally:
+            sem.release()
+
+    async with TaskGroup() as tg:
+        for arch, op_s in product(archs, oses):
+            await sem.acquire()
+            tg.create_task(probe(arch, op_s), context=EMPTY_CONTEXT)
+
+    return compat
+
+
+def bad_triples_path() -> Path:
+    """
+    Path of the Bloom filter of bad triples for the clang binary in `CMD_PREFIX`,
+    keyed on its inode and mtime and on a short hash of `CMD_SUFFIX` and `SOURCE`,
+    so a rebuilt clang or a changed command or program starts from an empty filter
+    """
+    clang_stat = stat(CMD_PREFIX[0])
+    inputs = blake2b(digest_size=4)
+    for part in CMD_SUFFIX:
+        inputs.update(part.encode() + b"\0")
+    inputs.update(SOURCE)
+
+    return BAD_TRIPLES_DIR / (
+        f"bad_triples-{clang_stat.st_ino}-{clang_stat.st_mtime_ns}"
+        f"-{inputs.hexdigest()}.bloom"
     )
 
-    if b"PLEASE" in out or b"PLEASE" in err:
-        return False, out + err
 
-    return res.returncode == 0, ""
+def load_bad_triples() -> Optional["BloomFilter"]:
+    """
+    Load the Bloom filter of triples a previous run with the same clang binary,
+    command and program found to be invalid without crashing it, or a fresh one
+    if there was no such run. Returns `None` if `pybloom_live` is not installed
+    """
+    if BloomFilter is None:
+        return None
+
+    path = bad_triples_path()
+
+    if path.exists():
+        with path.open("rb") as bloom_file:
+            return BloomFilter.fromfile(bloom_file)
+
+    return BloomFilter(capacity=3_000_000, error_rate=0.001)
 
 
-async def generate_triples() -> AsyncGenerator[str, None]:
+def save_bad_triples(bloom: "BloomFilter") -> None:
     """
-    Generate target triples, some of which may not be valid
+    Write out the Bloom filter of bad triples, replacing the previous one
+    atomically so an interrupted run never leaves a truncated filter
     """
-    oses = list(map(lambda x: x.value, ClangOS))
-    archs = list(map(lambda x: x.value, ClangArch))
-    vendors = list(map(lambda x: x.value, ClangVendor))
-    envs = list(map(lambda x: x.value, ClangEnvironment))
+    path = bad_triples_path()
+    partial = path.with_suffix(".partial")
 
-    for arch, vendor, op_s, environ in product(archs, vendors, oses, envs):
-        triple = ""
-        if arch:
-            triple += arch
+    with partial.open("wb") as bloom_file:
+        bloom.tofile(bloom_file)
 
-        if vendor:
-            triple += ("-" if triple else "") + vendor
+    replace(partial, path)
 
-        if op_s:
-            triple += ("-" if triple else "") + op_s
 
-        if environ:
-            triple += ("-" if triple else "") + environ
+def generate_triples(
+    compat: Dict[Tuple[str, str], str], bad: Container[str] = ()
+) -> List[str]:
+    """
+    Generate unique target triples, some of which may not be valid, skipping any
+    whose (arch, os) pair is known to be rejected by clang and any triple in `bad`
+    """
+    # Empty components are dropped, so different products can join to the same
+    # string; dict.fromkeys deduplicates while keeping generation order
+    triples = dict.fromkeys(
+        "-".join(filter(None, quad))
+        for quad in product(ARCHS, VENDORS, OSES, ENVIRONMENTS)
+        if compat.get((quad[0], quad[2])) != "unknown_triple"
+    )
 
-        yield triple
+    return [triple for triple in triples if triple and triple not in bad]
 
 
-async def main() -> None:
+async def check_triples(
+    triples: List[str], start: int, task_count: int, shard: int
+) -> Tuple[List[str], List[str]]:
     """
-    Run the script!
+    Check every triple with `task_count` concurrent clangs, collecting a report
+    with the stack trace of any triple that has one. `start` is the index of the
+    first triple in the full list, and reports are tagged with it and with `shard`.
+    Returns the triples that were invalid without crashing clang, and the reports
+    for the parent to write out
     """
-    tempfile = Path(f"/dev/shm/test/{uuid1()}.c")
-    tempfile.write_text("int main(){return 1;}")
+    bad: List[str] = []
+    reports: List[str] = []
+    queue: "Queue[Optional[Tuple[int, str]]]" = Queue(maxsize=task_count * 2)
 
-    async def check_triple(triple: str, i: int) -> None:
+    async def worker() -> None:
         """
-        Check a triple and dump out its stack trace if it has one
+        Long-lived worker that checks triples off the queue until it receives
+        `None`
         """
-        _valid, err = await check_valid_triple(triple, str(tempfile))
+        while (item := await queue.get()) is not None:
+            index, triple = item
+            valid, err = await check_valid_triple(triple)
 
-        if err:
-            print(f"Error checking triple (#{i}) `{triple}`:")
-            print(err)
+            if not valid and not err:
+                bad.append(triple)
 
-    tasks = set()
-    i = 0
-    l = 1
-    TASK_COUNT = 32
+            if err:
+                reports.append(
+                    f"Error checking triple (shard {shard} #{index}) `{triple}`:\n"
+                    f"{err}\n"
+                )
 
-    async for triple in generate_triples():
+    async with TaskGroup() as tg:
+        for _ in range(task_count):
+            tg.create_task(worker(), context=EMPTY_CONTEXT)
 
-        while len(tasks) >= TASK_COUNT:
-            done, tasks = await wait(tasks, return_when=FIRST_COMPLETED)
+        for item in enumerate(triples, start):
+            await queue.put(item)
+
+        for _ in range(task_count):
+            await queue.put(None)
+
+    return bad, reports
+
+
+def init_shard(slots: "ProcessQueue[Tuple[int, int, int]]") -> None:
+    """
+    Claim a (shard id, cpu, concurrent clangs) slot for this pool process and pin
+    it to that CPU
+    """
+    global SHARD
+
+    shard_id, cpu, task_count = slots.get()
+    sched_setaffinity(0, {cpu})
+    SHARD = (shard_id, task_count)
+
+
+def run_shard(chunk: Tuple[int, List[str]]) -> Tuple[List[str], List[str]]:
+    """
+    Check one chunk of the triples on this shard's own event loop. Shards never
+    write to stdout themselves: a write to a shared pipe larger than PIPE_BUF can
+    be split, letting another shard's output land inside a record
+    """
+    start, triples = chunk
+    shard_id, task_count = SHARD
+    return run_loop(check_triples(triples, start, task_count, shard_id))
+
+
+def main() -> None:
+    """
+    Run the script!
+    """
+    compat = run_loop(probe_compatibility())
+    bloom = load_bad_triples()
+    triples = generate_triples(compat, () if bloom is None else bloom)
+
+    # Split the TASK_COUNT clang slots across one shard per CPU, with no more
+    # shards than slots, so the total concurrency is exactly TASK_COUNT
+    cpus = sorted(sched_getaffinity(0))[:TASK_COUNT]
+    shards = len(cpus)
+    base, extra = divmod(TASK_COUNT, shards)
+    slots: "ProcessQueue[Tuple[int, int, int]]" = ProcessQueue()
+    for i, cpu in enumerate(cpus):
+        slots.put((i, cpu, base + (i < extra)))
+
+    # Hand out the triples in chunks rather than one slice per shard, so bad
+    # triples are saved as each chunk finishes and an interrupted run keeps them
+    chunks = [
+        (start, triples[start : start + CHECKPOINT_SIZE])
+        for start in range(0, len(triples), CHECKPOINT_SIZE)
+    ]
+    done = 0
+    last = 1
 
-            for task in done:
-                await task
-                i += 1
-                if i / l > 1.1:
-                    print(f"Done: {i}")
-                    l = i
+    with Pool(shards, initializer=init_shard, initargs=(slots,)) as pool:
+        for bad, reports in pool.imap_unordered(run_shard, chunks):
+            # The parent is the only writer, so a whole chunk's reports can go out
+            # in one write without another process landing inside a record
+            stdout.write("".join(reports))
+            stdout.flush()
 
-        task = create_task(check_triple(triple, i))
-        task.add_done_callback(tasks.discard)
-        tasks.add(task)
+            done += CHECKPOINT_SIZE
+            if done / last > 1.1:
+                print(f"Done: {min(done, len(triples))}", flush=True)
+                last = done
 
-    await wait(tasks)
+            if bloom is not None:
+                for triple in bad:
+                    bloom.add(triple)
 
-    unlink(tempfile.name)
+                save_bad_triples(bloom)
 
 
 if __name__ == "__main__":
-    get_event_loop().run_until_complete(main())
+    main()